@@ -115,41 +115,24 @@ def stack_with_padding(batch_as_list: list) -> tuple[torch.tensor, torch.tensor]
     with dtype torch.float32.
     Output should be of shape (batch_size, 2, H, W), (batch_size, 1, H*W)
     """
-    try:
-        stacked_pix_imgs = np.array([entry[0] for entry in batch_as_list], dtype=np.float32)
-        stacked_known_arrays = np.array([entry[1] for entry in batch_as_list], dtype=np.float32)
-
-        stacked_input = torch.from_numpy(np.concatenate((stacked_pix_imgs, stacked_known_arrays), axis=1))
-
-        target_arrays = torch.flatten(torch.from_numpy(np.array([entry[2] for entry in batch_as_list], dtype=np.float32)), start_dim=-2)
-        return stacked_input, target_arrays
-    except ValueError:
-        # TODO: Change this implementation to be more performant, use numpy arrays directly
-        # Most of the data will be same dimensions anyway so it should be fine
-        pix_imgs = [entry[0] for entry in batch_as_list]
-        known_arrays = [entry[1] for entry in batch_as_list]
-        target_arrays = [entry[2] for entry in batch_as_list]
-
-        max_height = max(pix_imgs, key=lambda x: x.shape[-2]).shape[-2]
-        max_width = max(pix_imgs, key=lambda x: x.shape[-1]).shape[-1]
-        
-        for i, (pix_img, known_array) in enumerate(zip(pix_imgs, known_arrays)):
-            pad_h = max_height - pix_img.shape[-2]
-            pad_w = max_width - pix_img.shape[-1]
-            
-            pix_imgs[i] = np.pad(pix_img, ((0, 0), (0, pad_h),(0, pad_w)), mode='constant', constant_values=0)
-            known_arrays[i] = np.pad(known_array, ((0, 0), (0, pad_h), (0, pad_w)), mode='constant', constant_values=1)
-            target_arrays[i] = np.pad(target_arrays[i], ((0, 0), (0, pad_h), (0, pad_w)), mode='constant', constant_values=0)
-        
-        pix_imgs = np.array(pix_imgs, dtype=np.float32)
-        known_arrays = np.array(known_arrays, dtype=np.float32)
-        stacked_input = torch.from_numpy(np.concatenate((pix_imgs, known_arrays), axis=1))
-
-        target_arrays = torch.flatten(torch.from_numpy(np.array(target_arrays, dtype=np.float32)), start_dim=-2)
-
-        return stacked_input, target_arrays
-    except:
-        raise ValueError("Something went wrong with stacking the batch")
+    # Preallocate the whole batch once and copy each sample into its corner, padding is
+    # implicit: pixelated images and targets are padded with 0, known arrays with 1.
+    # Pinning is left to the DataLoader, since workers must not initialize CUDA.
+    max_height = max(entry[0].shape[-2] for entry in batch_as_list)
+    max_width = max(entry[0].shape[-1] for entry in batch_as_list)
+    batch_size = len(batch_as_list)
+
+    stacked_input = torch.zeros((batch_size, 2, max_height, max_width), dtype=torch.float32)
+    stacked_input[:, 1] = 1
+    target_arrays = torch.zeros((batch_size, 1, max_height, max_width), dtype=torch.float32)
+
+    for i, (pix_img, known_array, target_array, *_) in enumerate(batch_as_list):
+        height, width = pix_img.shape[-2:]
+        stacked_input[i, :1, :height, :width] = torch.from_numpy(pix_img)
+        stacked_input[i, 1:, :height, :width] = torch.from_numpy(known_array)
+        target_arrays[i, :, :height, :width] = torch.from_numpy(target_array)
+
+    return stacked_input, torch.flatten(target_arrays, start_dim=-2)
 
 def get_files(path: str, extensions: list[str]) -> list[Path]:
     all_files = []
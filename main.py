@@ -32,9 +32,12 @@ if __name__ == '__main__':
     # Sadly this model could not finish training, probably because of an power outage during the night.
     # If this model happens to perform better, then my 5th submission is the best one.
 
-    # Careful to disable true_random for checking results with the following function
+    # Careful to disable true_random for checking results with the following function.
+    # training_loop only saves the state dict, so pass the architecture instance as model:
     #check_overfitting(datasets.RandomImagePixelationDataset('data_sandbox', (4, 32), (4, 32), (4, 16), true_random=False),
-    #                  "models_serious/Deepixv1(5,5,6,6,7,7,8)(3,5).pt")
+    #                  "models_serious/Deepixv1(5,5,6,6,7,7,8)(3,5).pt", model=model)
+
+    # The shipped model file holds a whole pickled module, after retraining pass model=model here as well
 
     plot_beatiful_samples(datasets.RandomImagePixelationDataset('data_sandbox', (4, 32), (4, 32), (4, 16), true_random=False),
                           "models_serious/Deepixv1(5,5,6,6,7,7,8)(3,5).pt", [5, 2, 11, 12, 16])
@@ -4,41 +4,87 @@ Author: Marcus Pertlwieser, 2023
 Provides general utility for the project.
 """
 
+import os
+from contextlib import nullcontext
+from math import isqrt
 import numpy as np
 from tqdm import tqdm
 import torch
 from torch.utils.data.dataloader import DataLoader
-from torch.utils.data import random_split
+from torch.utils.data import SubsetRandomSampler
 from torch.optim.lr_scheduler import StepLR
 import matplotlib.pyplot as plt
 import pickle
 
 from submission.submission_serialization import serialize, deserialize
 
-def checkpoint(model: torch.nn.Module, model_path: str, device:str) -> None:
+# Allow TF32 for matmuls and convolutions (free speedup on Ampere and newer) and let
+# cuDNN autotune its convolution algorithms, input shapes are static after cropping
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.backends.cudnn.benchmark = True
+
+def checkpoint(model: torch.nn.Module, model_path: str) -> None:
     """
-    Saves a model to a given path. Brings model to CPU for saving.
-    then back to device.
+    Saves the state dict of a model to a given path. The tensors are copied to CPU
+    for saving, the model itself stays on its device.
+    Load it again with model.load_state_dict(torch.load(model_path)), see load_model.
     """
-    model.to('cpu')
     if isinstance(model_path, str):
-        torch.save(model, model_path)
-    model.to(device)
+        torch.save({key: value.cpu() for key, value in model.state_dict().items()}, model_path)
     return
 
-# TODO: Add number of workers for dataloaders, add true random seed, improve early stopping by saving best model
-# Consider pinning memory to CPU for dataloaders, try non_blocking=True with removing syncs in epoch loop
+def load_model(model_path: str, model: torch.nn.Module=None, device: str='cpu') -> torch.nn.Module:
+    """
+    Loads a model saved to model_path onto device. If model is given, the file is expected
+    to hold a state dict (see checkpoint) which is loaded into model. Otherwise the file
+    is expected to hold a whole pickled module, as the older models in this repo do.
+    """
+    if model is None:
+        loaded = torch.load(model_path, map_location=device, weights_only=False)
+        if isinstance(loaded, dict):
+            raise ValueError(f"{model_path} holds a state dict, pass the architecture instance as model=")
+        return loaded
+    model.load_state_dict(torch.load(model_path, map_location=device))
+    return model.to(device)
+
+def loss_step(network: torch.nn.Module, loss_function: torch.nn.Module,
+              input: torch.Tensor, target: torch.Tensor) -> torch.Tensor:
+    """
+    Forward pass of network and loss computation, used as a single (compiled) step
+    in the training loop.
+    """
+    pred = network(input)
+    return loss_function(pred, target)
+
 def training_loop(
         network: torch.nn.Module, data: torch.utils.data.Dataset, num_epochs: int,
         optimizer: torch.optim.Optimizer, loss_function: torch.nn.Module, splits: tuple[float, float],
         minibatch_size: int=16, collate_func: callable=None, show_progress: bool = False, try_cuda: bool = False,
         early_stopping: bool = True, patience: int = 3, model_path: str=None, losses_path: str=None,
-        workers: int=0, pin_memory: bool=True, prefetch_factor: int=2) -> None:
+        workers: int=None, pin_memory: bool=True, prefetch_factor: int=2, persistent_workers: bool=True,
+        use_amp: bool=True, eval_every: int=1) -> None:
 
     # set device
     device = torch.device("cuda" if torch.cuda.is_available() and try_cuda else "cpu")
     print(device)
     network.to(device)
+    # NHWC layout lets cuDNN use its faster (tensor core) convolution kernels
+    memory_format = torch.channels_last if device.type == 'cuda' else torch.contiguous_format
+    network.to(memory_format=memory_format)
+
+    # Compile the forward + loss step rather than the network, so inductor can fuse the
+    # loss reduction into the last layer. Inputs are center cropped to a fixed size, so
+    # shapes stay static apart from the last minibatch.
+    step = loss_step
+    if device.type == 'cuda':
+        torch._dynamo.config.cache_size_limit = 64
+        step = torch.compile(loss_step, mode='reduce-overhead', dynamic=False)
+
+    # Mixed precision on CUDA: bfloat16 where supported, otherwise float16 with loss scaling
+    use_amp = use_amp and device.type == 'cuda'
+    amp_dtype = torch.bfloat16 if use_amp and torch.cuda.is_bf16_supported(including_emulation=False) else torch.float16
+    scaler = torch.amp.GradScaler('cuda', enabled=use_amp and amp_dtype == torch.float16)
 
     if data.true_random:
         rng = np.random.default_rng()
@@ -51,104 +97,184 @@ def training_loop(
     # Handle data
     if int(sum(splits)) != 1:
         raise ValueError("Splits must sum to 1.")
-    train_data, eval_data = random_split(data, splits)
-
-    train_dataloader = DataLoader(train_data, collate_fn=collate_func, batch_size=minibatch_size,
-                                  shuffle=True, num_workers=workers, pin_memory=pin_memory, prefetch_factor=prefetch_factor)
+    if eval_every < 1:
+        raise ValueError("eval_every must be at least 1.")
+    # Split by permuting indices with its own generator, samplers then index into data
+    # directly instead of going through Subset wrappers
+    indices = torch.randperm(len(data), generator=torch.Generator().manual_seed(int(seed))).tolist()
+    split = int(len(data) * splits[0])
+    train_indices, eval_indices = indices[:split], indices[split:]
+
+    # Leave some cores for the main process, more than 8 workers rarely pay off here
+    if workers is None:
+        workers = max(min((os.cpu_count() or 2) - 2, 8), 0)
     # a little less workers for eval is generally good in most cases
-    eval_dataloader = DataLoader(eval_data, collate_fn=collate_func, batch_size=minibatch_size,
-                                  shuffle=True, num_workers=(workers+1)//2, pin_memory=pin_memory, prefetch_factor=prefetch_factor)
+    eval_workers = (workers+1)//2
+    # pinned memory only helps host to device copies, stack_with_padding returns a plain
+    # tuple of tensors, so the default pinning logic handles it
+    pin_memory = pin_memory and device.type == 'cuda'
+
+    # Keep workers alive between epochs, otherwise they get respawned every epoch.
+    # prefetch_factor and persistent_workers are only valid with worker processes.
+    train_dataloader = DataLoader(data, collate_fn=collate_func, batch_size=minibatch_size,
+                                  sampler=SubsetRandomSampler(train_indices), num_workers=workers, pin_memory=pin_memory,
+                                  persistent_workers=persistent_workers and workers > 0,
+                                  prefetch_factor=prefetch_factor if workers > 0 else None)
+    # no need to shuffle for evaluation
+    eval_dataloader = DataLoader(data, collate_fn=collate_func, batch_size=minibatch_size,
+                                  sampler=eval_indices, num_workers=eval_workers, pin_memory=pin_memory,
+                                  persistent_workers=persistent_workers and eval_workers > 0,
+                                  prefetch_factor=prefetch_factor if eval_workers > 0 else None)
 
     # Hand model parameters to optimizer
     optimizer = optimizer(network.parameters())
     scheduler = StepLR(optimizer, step_size=15, gamma=0.1)
 
+    # number of minibatches does not change between epochs, also drop_last is off so
+    # every buffer entry gets written each epoch
+    num_train_batches = len(train_dataloader)
+    num_eval_batches = len(eval_dataloader)
+    # per minibatch losses are written into preallocated device buffers, which are
+    # only reduced and synced once per epoch
+    train_minibatch_losses = torch.empty(num_train_batches, device=device)
+    eval_minibatch_losses = torch.empty(num_eval_batches, device=device)
+    # eval batches are copied on a side stream, so the copies can overlap with the
+    # compute still queued on the default stream (end of the train epoch, previous
+    # eval batches). The train loss is only synced after eval is queued for this reason.
+    copy_stream = torch.cuda.Stream() if device.type == 'cuda' else None
+
     training_losses = []
     eval_losses = []
-    min_index = 0
+    eval_epochs = []
+    best_eval_loss = float('inf')
+    # patience is counted in evaluations, not epochs
+    evals_since_best = 0
     for epoch in tqdm(range(num_epochs), disable=not show_progress):
         # set model to training mode
         network.train()
-        train_minibatch_losses = []
-        for train_batch, target_batch in train_dataloader:
-            train_batch = train_batch.to(device, non_blocking=True)
+        for i, (train_batch, target_batch) in enumerate(train_dataloader):
+            train_batch = train_batch.to(device, non_blocking=True, memory_format=memory_format)
             target_batch = target_batch.to(device, non_blocking=True)
 
-            # clear gradients
-            network.zero_grad()
+            # clear gradients, dropping them instead of writing zeros
+            optimizer.zero_grad(set_to_none=True)
 
             # compute loss and propagate back
-            pred = network(train_batch)
-            loss = loss_function(pred, target_batch)
-            loss.backward()
-
-            # update model parameters
-            optimizer.step()
-
-            # append loss to list, detach gradients from tensor and move to cpu
-            train_minibatch_losses.append(loss.detach().cpu())
-        training_losses.append(torch.mean(torch.stack(train_minibatch_losses)))
+            with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=use_amp):
+                loss = step(network, loss_function, train_batch, target_batch)
+            scaler.scale(loss).backward()
+
+            # update model parameters, scaler is a no-op if disabled
+            scaler.step(optimizer)
+            scaler.update()
+
+            # detach gradients from tensor, the loss stays on device
+            train_minibatch_losses[i] = loss.detach()
+        # keep the mean on device, calling .item() here would wait for the train steps
+        # before the eval copies are queued
+        train_loss = train_minibatch_losses.mean()
+
+        # only evaluate every eval_every epochs (and always after the last one)
+        if epoch % eval_every != 0 and epoch != num_epochs - 1:
+            training_losses.append(train_loss.item())
+            scheduler.step()
+            continue
         
-        eval_minibatch_losses = []
         # set model to eval mode
         network.eval()
-        with torch.no_grad():
-            for eval_batch, target_batch in eval_dataloader:
-                eval_batch = eval_batch.to(device, non_blocking=True)
-                target_batch = target_batch.to(device, non_blocking=True)
-
-                pred = network(eval_batch)
-                loss = loss_function(pred, target_batch)
-
-                eval_minibatch_losses.append(loss.detach().cpu())
-        eval_losses.append(torch.mean(torch.stack(eval_minibatch_losses)))
+        with torch.inference_mode():
+            for i, (eval_batch, target_batch) in enumerate(eval_dataloader):
+                with torch.cuda.stream(copy_stream) if copy_stream is not None else nullcontext():
+                    eval_batch = eval_batch.to(device, non_blocking=True, memory_format=memory_format)
+                    target_batch = target_batch.to(device, non_blocking=True)
+                if copy_stream is not None:
+                    current_stream = torch.cuda.current_stream()
+                    current_stream.wait_stream(copy_stream)
+                    # tensors are used on the default stream, tell the allocator about it
+                    eval_batch.record_stream(current_stream)
+                    target_batch.record_stream(current_stream)
+
+                with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=use_amp):
+                    loss = step(network, loss_function, eval_batch, target_batch)
+
+                eval_minibatch_losses[i] = loss.detach()
+        training_losses.append(train_loss.item())
+        eval_losses.append(eval_minibatch_losses.mean().item())
+        eval_epochs.append(epoch)
 
         if early_stopping:
-            # mabye restrict the search to the last few entries
-            min_index_new = eval_losses.index(min(eval_losses))
-            if min_index_new != min_index: # model has improved
-                checkpoint(network, model_path, device)
+            # keep track of the best loss incrementally instead of searching the whole list
+            if eval_losses[-1] < best_eval_loss: # model has improved
+                best_eval_loss = eval_losses[-1]
+                evals_since_best = 0
+                checkpoint(network, model_path)
                 # Also plot losses then!
                 if isinstance(losses_path, str):
-                    plot_losses(training_losses, eval_losses, losses_path)
-            elif len(eval_losses) - 1 - min_index_new == patience:
-                if isinstance(losses_path, str):
-                    plot_losses(training_losses, eval_losses, losses_path)
-                network.to('cpu')
-                return
-            min_index = min_index_new
+                    plot_losses(training_losses, eval_losses, losses_path, eval_epochs)
+            else:
+                evals_since_best += 1
+                if evals_since_best >= patience:
+                    if isinstance(losses_path, str):
+                        plot_losses(training_losses, eval_losses, losses_path, eval_epochs)
+                    network.to('cpu')
+                    return
         
         scheduler.step()
 
-    checkpoint(network, model_path, device)
+    # with early stopping the best model was already checkpointed, don't overwrite it
+    if not early_stopping or best_eval_loss == float('inf'):
+        checkpoint(network, model_path)
     if isinstance(losses_path, str):
-        plot_losses(training_losses, eval_losses, losses_path)
+        plot_losses(training_losses, eval_losses, losses_path, eval_epochs)
     return
 
-def test_loop_serialized(model_path: str, data_path: str, submission_path: str) -> None:
+def test_loop_serialized(model_path: str, data_path: str, submission_path: str, batch_size: int=64,
+                         model: torch.nn.Module=None, try_cuda: bool=False) -> None:
     """
     This function is used to test the specified model (model_path) on the provided
     pickle file, which serves as a test set. The predictions should be gathered in a
     list of 1D Numpy arrays with dtype uint8 (so rescaling necessary!). This list
     should then be serialized to file using the provided submission_serialization.py.
+    The test set is moved to device in one go and predicted in chunks of batch_size.
+    If model is given, model_path is expected to hold its state dict.
     """
-    
-    model = torch.load(model_path)
+    device = torch.device("cuda" if torch.cuda.is_available() and try_cuda else "cpu")
+    model = load_model(model_path, model, device)
     model.eval()
     predictions = []
 
     with open(data_path, 'rb') as f:
         dictionary = pickle.load(f)
-        with torch.no_grad():
-            a=1
-            for (pixelated_image, known_array) in zip(dictionary['pixelated_images'], dictionary['known_arrays']):
-                input = np.concatenate((pixelated_image/255, known_array), axis=0)
-                input = torch.from_numpy(input).unsqueeze(0).float()
-                pred = model(input).numpy()*255
-                pred = pred.astype(np.uint8)
-                pred = np.squeeze(pred)
+
+    # The test images are copied into one (pinned) uint8 buffer and transferred at once,
+    # stacking and scaling happens on device. This needs uint8 images of the same shape.
+    known_arrays = dictionary['known_arrays']
+    pixelated_images = dictionary['pixelated_images']
+    shape = pixelated_images[0].shape
+    if len(shape) != 3 or shape[0] != 1:
+        raise ValueError(f"Pixelated images must have shape (1, H, W), got {shape}")
+    for i, (pixelated_image, known_array) in enumerate(zip(pixelated_images, known_arrays)):
+        if pixelated_image.dtype != np.uint8:
+            raise ValueError(f"Pixelated image {i} has dtype {pixelated_image.dtype}, expected uint8")
+        if pixelated_image.shape != shape or known_array.shape != shape:
+            raise ValueError(f"Image {i} has shapes {pixelated_image.shape} and {known_array.shape}, expected {shape}")
+    buffer = torch.empty((len(pixelated_images), 2, *shape[-2:]), dtype=torch.uint8,
+                         pin_memory=device.type == 'cuda')
+    buffer_np = buffer.numpy()
+    for i, (pixelated_image, known_array) in enumerate(zip(pixelated_images, known_arrays)):
+        buffer_np[i, 0] = pixelated_image[0]
+        buffer_np[i, 1] = known_array[0]
+    inputs = buffer.to(device, non_blocking=True).float()
+    # only the pixelated channel is scaled, known arrays are already 0/1
+    inputs[:, 0].div_(255)
+
+    with torch.inference_mode():
+        for start in range(0, len(inputs), batch_size):
+            preds = model(inputs[start:start+batch_size])
+            preds = preds.mul_(255).clamp_(0, 255).to(torch.uint8).cpu().numpy()
+            for pred, known_array in zip(preds, known_arrays[start:start+batch_size]):
                 # Prediction should only be the unknown part of the image:
-                predictions.append(np.extract(known_array.flatten() == 0, pred))
+                predictions.append(np.extract(known_array.flatten() == 0, np.squeeze(pred)))
     
     serialize(predictions, submission_path)
 
@@ -165,16 +291,15 @@ def plot_sample(data_sample: tuple[np.ndarray, np.ndarray, np.ndarray, str]) ->
     plt.suptitle(path)
     plt.show()
 
-def check_overfitting(data: torch.utils.data.Dataset, model_path: str) -> None:
+def check_overfitting(data: torch.utils.data.Dataset, model_path: str, model: torch.nn.Module=None) -> None:
     """
     Takes in dataset and model path to check if an overfitted model has
     plausible predictions on the training set.
+    If model is given, model_path is expected to hold its state dict.
     """
-    model = torch.load(model_path)
+    model = load_model(model_path, model)
     model.eval()
-    # just to be sure:
-    model.to('cpu')
-    with torch.no_grad():
+    with torch.inference_mode():
         for i in range(10):
             truth = data.get_image(i)
             pix = data[i][0]
@@ -188,14 +313,13 @@ def check_overfitting(data: torch.utils.data.Dataset, model_path: str) -> None:
             visualize_flat_u8int(pred, axs[2])
             plt.show()
 
-def plot_beatiful_samples(data: torch.utils.data.Dataset, model_path: str, indices: list[str]) -> None:
+def plot_beatiful_samples(data: torch.utils.data.Dataset, model_path: str, indices: list[str],
+                          model: torch.nn.Module=None) -> None:
     assert len(indices) >= 2, "Please provide at least two indices!"
 
-    model = torch.load(model_path)
+    model = load_model(model_path, model)
     model.eval()
-    # just to be sure:
-    model.to('cpu')
-    with torch.no_grad():
+    with torch.inference_mode():
         count = 0
         fig, axs = plt.subplots(len(indices), 3, figsize=(12, 16))
 
@@ -220,12 +344,16 @@ def plot_beatiful_samples(data: torch.utils.data.Dataset, model_path: str, indic
     plt.show()
         
 
-def plot_losses(training_losses: list[float], eval_losses: list[float], path: str) -> None:
+def plot_losses(training_losses: list[float], eval_losses: list[float], path: str,
+                eval_epochs: list[int]=None) -> None:
     """
     Takes in training losses and evaluation losses and saves plots to path-directory.
+    eval_epochs holds the epochs the evaluation losses belong to, defaults to every epoch.
     """
+    if eval_epochs is None:
+        eval_epochs = range(len(eval_losses))
     plt.plot(training_losses, label='Train loss')
-    plt.plot(eval_losses, label='Evaluation loss')
+    plt.plot(eval_epochs, eval_losses, label='Evaluation loss')
     plt.ylabel('MSE Loss')
     plt.xlabel('Epoch')
     plt.legend()
@@ -237,11 +365,12 @@ def visualize_flat_u8int(image: np.ndarray, ax) -> None:
     on a matplotlib subplot axis.
     """
     dim = image.shape[-1]
-    sqrt_dim = int(np.sqrt(dim))
-    try:
-        img = image.copy().reshape((int(sqrt_dim), int(sqrt_dim)))
-    except:
+    # exact integer square root, no float precision issues
+    sqrt_dim = isqrt(dim)
+    if sqrt_dim * sqrt_dim != dim or image.size != dim:
         raise ValueError("Image must be square.")
+    # imshow does not modify the data, so a view is enough
+    img = image.reshape((sqrt_dim, sqrt_dim))
     ax.imshow(img, cmap='gray', vmin=0, vmax=255)
 
 def kernel_interp(range: tuple[int, int], num:int, hidden_layers:int) -> int: